@@ -6,13 +6,22 @@ Created on Fri Nov 22 13:31:45 2024
 @author: antoinemaratray
 """
 
+import functools
+import hashlib
+import hmac
+import os
+import secrets
+import tempfile
+import time
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
 import streamlit as st
+import numpy as np
 import pandas as pd
-import seaborn as sns
 import matplotlib.pyplot as plt
 from statsbombpy import sb
 import matplotlib.colors as mcolors
-import matplotlib.cm as cm
 
 # Manual mapping of competitions and seasons
 COMPETITIONS = {
@@ -58,73 +67,236 @@ METRICS = {
     "team_match_np_xg_conceded": "xG Conceded"
 }
 
-@st.cache_data
+# Lookups derived once at import rather than on every rerun
+NAME_TO_COMP_ID = {v: k for k, v in COMPETITIONS.items()}
+NAME_TO_SEASON_ID = {v: k for k, v in SEASONS.items()}
+METRIC_COLUMNS = list(METRICS.keys())
+METRIC_LABELS = list(METRICS.values())
+
+# Bar colors, light to dark by games managed
+CUSTOM_CMAP = mcolors.LinearSegmentedColormap.from_list("", ["#bbdefb", "#0d47a1"])
+
+# Fetched data is persisted here as Parquet so later app starts skip the API. Files
+# expire after a day so selections that include an ongoing season pick up new matches.
+CACHE_DIR = Path(__file__).parent / ".cache"
+CACHE_MAX_AGE = 24 * 60 * 60
+# Random per-install key for the cache filenames, kept outside the repo so a listing
+# of CACHE_DIR cannot be used to test password guesses offline
+CACHE_SECRET_FILE = Path.home() / ".config" / "gafferpy" / "cache_secret"
+
+# Concurrency and retry settings for the StatsBomb API
+MAX_WORKERS = 16
+MAX_RETRIES = 3
+RETRY_BACKOFF = 0.5
+
+def stack_categoricals(first, second):
+    # Shared categories first: a side with no values at all (e.g. no away managers
+    # recorded) gets empty categories of another dtype, which union_categoricals rejects
+    categories = first.cat.categories.union(second.cat.categories)
+    return pd.Categorical(np.concatenate([first.to_numpy(), second.to_numpy()]), categories=categories)
+
+def stack_teams(matches):
+    # One row per (match, side), home rows then away rows, built in a single pass
+    rows = np.tile(np.arange(len(matches)), 2)
+    return pd.DataFrame({
+        "match_id": matches["match_id"].to_numpy()[rows],
+        "team_name": stack_categoricals(matches["home_team"], matches["away_team"]),
+        "manager": stack_categoricals(matches["home_managers"], matches["away_managers"]),
+        "competition": matches["competition"].array.take(rows),
+        "season": matches["season"].array.take(rows)
+    })
+
+@st.cache_data(ttl=CACHE_MAX_AGE)
 def fetch_manager_data(email, password, competitions, seasons):
-    all_manager_data = []
     all_matches = []
-
-    for comp_id, comp_name in competitions.items():
-        for season_id, season_name in seasons.items():
-            try:
-                matches = sb.matches(
-                    competition_id=comp_id,
-                    season_id=season_id,
-                    creds={"user": email, "passwd": password}
-                )
-                matches["competition"] = comp_name
-                matches["season"] = season_name
-                all_matches.append(matches)
-
-                manager_data = matches[["home_team", "home_managers", "away_team", "away_managers", "competition", "season"]]
-                home_managers = manager_data[["home_team", "home_managers", "competition", "season"]].rename(
-                    columns={"home_team": "team_name", "home_managers": "manager"}
-                )
-                away_managers = manager_data[["away_team", "away_managers", "competition", "season"]].rename(
-                    columns={"away_team": "team_name", "away_managers": "manager"}
-                )
-                all_manager_data.append(pd.concat([home_managers, away_managers]).drop_duplicates())
-            except Exception as e:
-                st.warning(f"Error fetching data for {comp_name} - {season_name}: {e}")
-
-    return pd.concat(all_manager_data, ignore_index=True), pd.concat(all_matches, ignore_index=True)
-
-@st.cache_data
-def fetch_team_stats(email, password, matches, manager_data):
-    team_stats = []
-
-    for _, row in manager_data.iterrows():
-        team_name = row["team_name"]
-        manager_name = row["manager"]
-
-        team_matches = matches[
-            ((matches["home_team"] == team_name) & (matches["home_managers"].str.contains(manager_name, na=False))) |
-            ((matches["away_team"] == team_name) & (matches["away_managers"].str.contains(manager_name, na=False)))
+    complete = True
+    creds = {"user": email, "passwd": password}
+
+    # Calendar-year and split-year seasons mix in SEASONS, so many selected pairs do not
+    # exist. Only request pairs the account lists; the rest simply have no matches, so a
+    # failure below can only be a transient error on a real pair.
+    available = sb.competitions(creds=creds)
+    if available.empty:
+        raise RuntimeError("Could not fetch the competition list from StatsBomb. Check your credentials.")
+    available = set(zip(available["competition_id"], available["season_id"]))
+    tasks = [
+        (comp_id, comp_name, season_id, season_name)
+        for comp_id, comp_name in competitions.items()
+        for season_id, season_name in seasons.items()
+        if (comp_id, season_id) in available
+    ]
+
+    # Fetch every (competition, season) concurrently
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        futures = [
+            executor.submit(
+                sb.matches,
+                competition_id=comp_id,
+                season_id=season_id,
+                creds=creds
+            )
+            for comp_id, _, season_id, _ in tasks
         ]
 
-        data = []
-        for match_id in team_matches["match_id"].unique():
+    # Collect results on the main thread, where st.warning can render
+    for (comp_id, comp_name, season_id, season_name), future in zip(tasks, futures):
+        try:
+            matches = future.result()
+            matches["competition"] = comp_name
+            matches["season"] = season_name
+            # Normalize missing managers once so downstream code only has to check for NA
+            matches[["home_managers", "away_managers"]] = matches[["home_managers", "away_managers"]].replace("", pd.NA)
+            all_matches.append(matches)
+        except Exception as e:
+            complete = False
+            st.warning(f"Error fetching data for {comp_name} - {season_name}: {e}")
+
+    if not all_matches:
+        raise RuntimeError("No matches found for the selected competitions and seasons.")
+
+    # Concatenate once, after the loop. The low-cardinality string columns become
+    # categoricals so merges and groupbys hash integer codes.
+    matches = pd.concat(all_matches, ignore_index=True).astype(
+        {col: "category" for col in ["home_team", "home_managers", "away_team", "away_managers", "competition", "season"]}
+    )
+    manager_data = stack_teams(matches)[["team_name", "manager", "competition", "season"]].drop_duplicates(ignore_index=True)
+    return manager_data, matches, complete
+
+# Memoized across managers and reruns. statsbombpy turns any non-200 response
+# (e.g. 429 rate limiting) into an empty frame, so raise on empty results to let
+# the caller retry and keep lru_cache from storing them.
+@functools.lru_cache(maxsize=None)
+def _team_match_stats(match_id, email, password):
+    stats = sb.team_match_stats(
+        match_id=match_id,
+        creds={"user": email, "passwd": password}
+    )
+    if stats.empty:
+        raise RuntimeError(f"No team match stats returned for match {match_id}")
+    return stats
+
+def fetch_match_stats(match_id, email, password):
+    # Retry with exponential backoff; give up quietly like the serial loop did
+    for attempt in range(MAX_RETRIES):
+        try:
+            return _team_match_stats(match_id, email, password)
+        except Exception:
+            if attempt < MAX_RETRIES - 1:
+                time.sleep(RETRY_BACKOFF * 2 ** attempt)
+    return None
+
+@st.cache_data(ttl=CACHE_MAX_AGE)
+def fetch_team_stats(email, password, matches):
+    # Each team and manager is averaged over every loaded match, across competitions and seasons
+    keys = ["team_name", "manager"]
+
+    # Fetch every played match once, concurrently. Scheduled fixtures in ongoing
+    # seasons have no stats yet, so they are not requested and not counted as failures.
+    played = matches["match_status"] == "available" if "match_status" in matches.columns else slice(None)
+    match_ids = matches.loc[played, "match_id"].unique()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        results = executor.map(lambda match_id: fetch_match_stats(match_id, email, password), match_ids)
+        match_stats = {
+            match_id: stats
+            for match_id, stats in zip(match_ids, results)
+            if stats is not None and not stats.empty
+        }
+    if not match_stats:
+        raise RuntimeError("Could not fetch team match stats for any of the selected matches.")
+
+    # Tag every team's row of every fetched match with its manager
+    team_matches = stack_teams(matches)
+    stats = pd.concat([frame.assign(match_id=match_id) for match_id, frame in match_stats.items()], ignore_index=True)
+    stats = team_matches.merge(stats[["match_id", "team_name"] + METRIC_COLUMNS], on=["match_id", "team_name"])
+
+    # One aggregation over all (team, manager) groups, metric columns only
+    team_stats = stats.groupby(keys, observed=True, sort=False)[METRIC_COLUMNS].mean()
+    team_stats["games_managed"] = team_matches.groupby(keys, observed=True, sort=False)["match_id"].nunique()
+    # Matches that still failed or came back empty after retries are left out;
+    # complete tells the caller
+    return team_stats.reset_index(), len(match_stats) == len(match_ids)
+
+# Cached on the data and slider values, so reruns with unchanged filters skip the work
+@st.cache_data
+def apply_filters(cleaned_data, min_matches, metric_ranges):
+    # metric_ranges holds one (low, high) slider tuple per METRICS label, in order
+    # Check every range in one pass over a 2-D array, combining the bounds in place;
+    # NaN fails like between() does
+    values = cleaned_data[METRIC_LABELS].to_numpy(dtype=float)
+    lows, highs = np.array(metric_ranges, dtype=float).T
+    within = values >= lows
+    within &= values <= highs
+    mask = within.all(axis=1)
+    mask &= cleaned_data["games_managed"].to_numpy(dtype=float) >= min_matches
+    return cleaned_data.loc[mask]
+
+@functools.lru_cache(maxsize=None)
+def cache_secret():
+    # Created once with owner-only permissions; O_EXCL makes a concurrent first run
+    # read the other run's key instead of overwriting it
+    CACHE_SECRET_FILE.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+    try:
+        fd = os.open(CACHE_SECRET_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        secret = CACHE_SECRET_FILE.read_bytes()
+        if len(secret) != 32:
+            raise OSError(f"Invalid cache secret in {CACHE_SECRET_FILE}")
+        return secret
+    secret = secrets.token_bytes(32)
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+def load_data(email, password, competitions, seasons):
+    # Parquet files keyed by the full credentials and selection outlive the Streamlit
+    # process; a hit skips StatsBomb, so a wrong password must never match a key. The
+    # key is an HMAC under the per-install secret, not a plain hash of the password.
+    try:
+        key = hmac.new(
+            cache_secret(),
+            f"{email}\0{password}\0{sorted(competitions)}\0{sorted(seasons)}".encode(),
+            hashlib.sha256
+        ).hexdigest()[:32]
+        paths = [CACHE_DIR / f"{key}_{name}.parquet" for name in ("manager_data", "matches", "team_stats")]
+    except OSError as e:
+        st.warning(f"Local cache disabled: {e}")
+        paths = None
+    if paths and all(path.exists() and time.time() - path.stat().st_mtime < CACHE_MAX_AGE for path in paths):
+        # An unreadable file is treated as a miss and replaced by the fetch below
+        try:
+            return tuple(pd.read_parquet(path, engine="pyarrow") for path in paths)
+        except Exception:
+            pass
+
+    manager_data, matches, matches_complete = fetch_manager_data(email, password, competitions, seasons)
+    team_stats, stats_complete = fetch_team_stats(email, password, matches)
+
+    # Partial results are shown but never persisted or memoized, so the next load retries
+    if not (matches_complete and stats_complete):
+        fetch_manager_data.clear()
+        fetch_team_stats.clear()
+        st.warning("Some StatsBomb requests failed, so these results are incomplete and were not cached.")
+        return manager_data, matches, team_stats
+    if paths is None:
+        return manager_data, matches, team_stats
+
+    try:
+        CACHE_DIR.mkdir(exist_ok=True)
+        # Write to a temp file and rename it into place, so a crash mid-write never
+        # leaves a truncated file under the final name
+        for frame, path in zip((manager_data, matches, team_stats), paths):
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+            os.close(fd)
             try:
-                team_match = sb.team_match_stats(
-                    match_id=match_id,
-                    creds={"user": email, "passwd": password}
-                )
-                team_match = team_match[team_match["team_name"] == team_name]
-                if not team_match.empty:
-                    data.append(team_match)
-            except Exception:
-                pass
-
-        if data:
-            data = pd.concat(data)
-            avg_stats = data.mean(numeric_only=True).to_dict()
-            avg_stats["manager"] = manager_name
-            avg_stats["team_name"] = team_name
-            avg_stats["competition"] = row["competition"]
-            avg_stats["season"] = row["season"]
-            avg_stats["games_managed"] = len(team_matches)
-            team_stats.append(avg_stats)
-
-    return pd.DataFrame(team_stats)
+                frame.to_parquet(tmp_path, engine="pyarrow", compression="zstd")
+                os.replace(tmp_path, path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+    except Exception as e:
+        st.warning(f"Error writing local cache: {e}")
+
+    return manager_data, matches, team_stats
 
 st.title("Manager Analysis with StatsBomb Data")
 
@@ -156,21 +328,36 @@ if email and password:
     st.sidebar.slider("Possession Ratio", 0.0, 1.0, (0.0, 1.0), 0.05, key="possession_range")
     st.sidebar.slider("xG Conceded", 3.0, 0.0, (3.0, 0.0), -0.1, key="xg_conceded_range")
 
+    # Drop all cached API responses, local Parquet files and filters so the next load re-fetches
+    if st.sidebar.button("Clear Cache"):
+        st.cache_data.clear()
+        _team_match_stats.cache_clear()
+        for path in [*CACHE_DIR.glob("*.parquet"), *CACHE_DIR.glob("*.tmp")]:
+            path.unlink(missing_ok=True)
+        st.session_state.data_loaded = False
+
     if st.sidebar.button("Load Data") or st.session_state.data_loaded:
         if not st.session_state.data_loaded:
             try:
-                selected_comp_ids = {k: v for k, v in COMPETITIONS.items() if v in selected_competitions}
-                selected_season_ids = {k: v for k, v in SEASONS.items() if v in selected_seasons}
+                selected_comp_ids = {NAME_TO_COMP_ID[name]: name for name in selected_competitions}
+                selected_season_ids = {NAME_TO_SEASON_ID[name]: name for name in selected_seasons}
 
-                manager_data, matches = fetch_manager_data(email, password, selected_comp_ids, selected_season_ids)
-                team_stats = fetch_team_stats(email, password, matches, manager_data)
+                manager_data, matches, team_stats = load_data(email, password, selected_comp_ids, selected_season_ids)
 
                 st.info("Merging and cleaning data...")
-                merged_data = pd.merge(manager_data, team_stats, on=["team_name", "manager", "competition", "season"], how="left")
-                cleaned_data = merged_data[["team_name", "manager", "games_managed", "competition", "season"] + list(METRICS.keys())]
-                cleaned_data.rename(columns=METRICS, inplace=True)
-
-                cleaned_data = cleaned_data[cleaned_data["games_managed"] >= st.session_state.min_matches]
+                # Share manager_data's categories so the join matches on integer codes
+                keys = ["team_name", "manager"]
+                team_stats = team_stats.astype(manager_data.dtypes[keys].to_dict())
+                merged_data = manager_data.set_index(keys).join(team_stats.set_index(keys), how="left", validate="m:1").reset_index()
+                # Keep managers with enough games (empty names are NA since ingestion) and the
+                # displayed columns in one selection; season is not shown, so it is never copied
+                keep = (merged_data["games_managed"] >= st.session_state.min_matches) & merged_data["manager"].notna()
+                cleaned_data = (
+                    merged_data.loc[keep, ["team_name", "manager", "games_managed", "competition"] + METRIC_COLUMNS]
+                    .rename(columns=METRICS)
+                    # Remove duplicate rows where the same manager is managing the same team
+                    .drop_duplicates(subset=["manager", "team_name", "competition"])
+                )
 
                 st.session_state.manager_data = manager_data
                 st.session_state.matches = matches
@@ -181,34 +368,28 @@ if email and password:
                 st.error(f"Error: {e}")
                 st.stop()
 
-        # Use data from session state
+        # Use data from session state, already cleaned once at load time
         cleaned_data = st.session_state.cleaned_data
 
-        # Remove rows where the 'manager' column is empty or NaN
-        cleaned_data = cleaned_data[cleaned_data['manager'].notnull() & (cleaned_data['manager'] != "")]
-
-        # Remove duplicate rows where the same manager is managing the same team
-        cleaned_data = cleaned_data.drop_duplicates(subset=["manager", "team_name", "competition"])
-
-        # Drop the 'season' column
-        cleaned_data = cleaned_data.drop(columns=["season"])
-
         st.write("### Merged Data for Selected Competitions and Seasons")
         st.dataframe(cleaned_data)
 
         # Apply filtering logic based on slider values
-        filtered_data = cleaned_data[
-            (cleaned_data["games_managed"] >= st.session_state.min_matches) &
-            (cleaned_data["Open Play xG"].between(*st.session_state.op_xg_range)) &
-            (cleaned_data["Set Piece xG"].between (*st.session_state.sp_xg_range)) &
-            (cleaned_data["PPDA"].between (*st.session_state.ppda_range)) &
-            (cleaned_data["Counter Attacking Shots"].between (*st.session_state.counter_shots_range)) &
-            (cleaned_data["Open Play Shot Distance"].between (*st.session_state.shot_distance_range)) &
-            (cleaned_data["Open Play Shot Distance Conceded"].between (*st.session_state.shot_distance_conceded_range)) &
-            (cleaned_data["Pressures in opposition half Ratio"].between (*st.session_state.fhalf_pressure_range)) &
-            (cleaned_data["Possession Ratio"].between (*st.session_state.possession_range)) &
-            (cleaned_data["xG Conceded"].between (*st.session_state.xg_conceded_range))
-        ]
+        filtered_data = apply_filters(
+            cleaned_data,
+            st.session_state.min_matches,
+            (
+                st.session_state.op_xg_range,
+                st.session_state.sp_xg_range,
+                st.session_state.ppda_range,
+                st.session_state.counter_shots_range,
+                st.session_state.shot_distance_range,
+                st.session_state.shot_distance_conceded_range,
+                st.session_state.fhalf_pressure_range,
+                st.session_state.possession_range,
+                st.session_state.xg_conceded_range
+            )
+        )
         if filtered_data.empty:
             st.warning("No managers meet the selected criteria. Adjust your filters and try again.")
         else:
@@ -216,39 +397,29 @@ if email and password:
             st.dataframe(filtered_data)
 
 
-            # Normalize games managed for the color mapping
+            # Map the number of games managed to colors, one RGBA row per manager
             norm = mcolors.Normalize(vmin=filtered_data["games_managed"].min(), vmax=filtered_data["games_managed"].max())
-            cmap = cm.get_cmap("Reds")  # Choose a colormap or define a custom one
-            
-            # Define your custom gradient colors
-            custom_cmap = mcolors.LinearSegmentedColormap.from_list("", ["#bbdefb", "#0d47a1"])
-            
-            # Map the number of games managed to colors
-            colors = filtered_data["games_managed"].apply(lambda x: custom_cmap(norm(x)))
+            colors = CUSTOM_CMAP(norm(filtered_data["games_managed"].to_numpy()))
 
             st.write("### Comparison | Darker: More Games Managed")
-            # Normalize the 'games_managed' column for consistent color mapping
-            norm = mcolors.Normalize(vmin=filtered_data["games_managed"].min(), vmax=filtered_data["games_managed"].max())
-            color_map = {manager: custom_cmap(norm(games)) for manager, games in zip(filtered_data["manager"], filtered_data["games_managed"])}
-            
-            for metric, label in METRICS.items():
-                if label in filtered_data.columns:  # Ensure the column exists in the filtered data
-                    fig, ax = plt.subplots(figsize=(8, 6))
-            
-                    # Generate a list of colors based on the manager's games managed
-                    color_list = [color_map[manager] for manager in filtered_data["manager"]]
-            
-                    # Plot using the consistent color list
-                    sns.barplot(
-                        data=filtered_data,
-                        x=label,  # Use the mapped column name for the x-axis
-                        y="manager",
-                        palette=color_list,  # Apply the consistent color list
-                        ax=ax
-                    )
-            
-                    # Set chart title and labels
-                    ax.set_title(f"{label}")
-                    ax.set_xlabel("")  # Remove x-axis label
-                    ax.set_ylabel("Managers")
-                    st.pyplot(fig)
+            managers = filtered_data["manager"].to_numpy()
+            positions = np.arange(len(managers))
+            fig, axes = plt.subplots(3, 3, figsize=(18, 18))
+
+            for ax, (metric, label) in zip(axes.ravel(), METRICS.items()):
+                if label not in filtered_data.columns:  # Ensure the column exists in the filtered data
+                    ax.axis("off")
+                    continue
+
+                # One bar per row, top to bottom in table order, using the consistent colors
+                ax.barh(positions, filtered_data[label].to_numpy(), color=colors)
+                ax.set_yticks(positions, labels=managers)
+                ax.invert_yaxis()
+
+                # Set chart title and labels
+                ax.set_title(f"{label}")
+                ax.set_xlabel("")  # Remove x-axis label
+                ax.set_ylabel("Managers")
+
+            fig.tight_layout()
+            st.pyplot(fig)